@@ -362,7 +362,7 @@ async def get_album(album_id: str):
         raise HTTPException(status_code=500, detail="Spotify service not configured")
 
     try:
-        album = spotify_service.get_album_details(album_id)
+        album = await spotify_service.get_album_details(album_id)
         if not album:
             raise HTTPException(status_code=404, detail="Album not found")
         return album
@@ -594,7 +594,7 @@ async def download_album(request: AlbumDownloadRequest, background_tasks: Backgr
         raise HTTPException(status_code=500, detail="Spotify service not configured")
 
     # Get album details
-    album = spotify_service.get_album_details(request.album_id)
+    album = await spotify_service.get_album_details(request.album_id)
 
     if not album:
         raise HTTPException(status_code=404, detail="Album not found")
@@ -20,6 +20,10 @@ DOWNLOAD_DIR = os.getenv("DOWNLOAD_DIR", "./downloads")  # Temporary download lo
 OUTPUT_FORMAT = os.getenv("OUTPUT_FORMAT", "mp3")
 AUDIO_QUALITY = os.getenv("AUDIO_QUALITY", "128")  # kbps (lower = smaller files, 128 is good balance)
 
+# Cache Configuration
+SPOTIFY_CACHE_DIR = os.getenv("SPOTIFY_CACHE_DIR", "./cache/spotify")  # Persistent metadata cache location
+SPOTIFY_CACHE_TTL = int(os.getenv("SPOTIFY_CACHE_TTL", "86400"))  # seconds (track/album metadata rarely changes)
+
 # YouTube Configuration
 YOUTUBE_COOKIES_PATH = os.getenv("YOUTUBE_COOKIES_PATH", "")  # Path to YouTube cookies file (Netscape format) for yt-dlp
 
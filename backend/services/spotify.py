@@ -1,12 +1,107 @@
+import asyncio
+import diskcache
+import logging
+import orjson
+import requests
 import spotipy
+import time
+from cachetools import TTLCache
+from concurrent.futures import Future
+from operator import itemgetter
+from spotipy.exceptions import SpotifyException
 from spotipy.oauth2 import SpotifyClientCredentials
+from threading import Lock, RLock
 from typing import List, Dict, Optional
 import sys
 import os
 sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 import config
 
+logger = logging.getLogger(__name__)
+
+# Fields guaranteed on both full and simplified track objects, extracted in
+# one C-level call instead of one dict lookup each; optional fields
+# (track_number, preview_url) stay on .get below
+_TRACK_FIELDS = itemgetter('id', 'name', 'artists', 'duration_ms', 'external_urls')
+
+
+class _OrjsonSession(requests.Session):
+    """Requests session whose responses decode JSON with orjson
+
+    spotipy calls response.json() on every API response; orjson decodes the
+    large paginated album payloads several times faster than the stdlib
+    decoder, and raises a ValueError subclass so spotipy's error handling
+    still applies.
+    """
+
+    def request(self, *args, **kwargs):
+        response = super().request(*args, **kwargs)
+        response.json = lambda **kw: orjson.loads(response.content)
+        return response
+
+
 class SpotifyService:
+    # Spotify returns at most 50 album tracks per page; cap how many pages we
+    # request at once to stay inside the 30-second rolling rate window
+    MAX_CONCURRENT_PAGES = 8
+
+    # Maximum number of IDs accepted by the batch /v1/tracks endpoint
+    TRACKS_BATCH_SIZE = 50
+
+    # Search results drift as Spotify's index changes, so persist them for a
+    # shorter window than ID-keyed metadata
+    SEARCH_CACHE_TTL = 3600
+
+    # How many times to retry a rate-limited or transiently failing call
+    MAX_RETRIES = 3
+
+    @staticmethod
+    def _serialize_album_images(images: List[Dict]) -> Optional[str]:
+        """Pick the largest image (first in array, sorted by size descending)"""
+        return images[0]['url'] if images else None
+
+    @staticmethod
+    def _serialize_track(item: Dict, *, album_name: str, album_id: str,
+                         album_art: Optional[str], release_date: str) -> Dict:
+        """Build the track dict returned by every lookup/search method"""
+        track_id, name, artists, duration_ms, external_urls = _TRACK_FIELDS(item)
+        # Artist lists are almost always length 1-3; a tuple is smaller than a
+        # list and str.join/JSON encoding take it as-is
+        names = tuple([artist['name'] for artist in artists])
+        get = item.get
+        return {
+            'id': track_id,
+            'name': name,
+            'artists': names,
+            'artist': ', '.join(names),
+            'album': album_name,
+            'album_id': album_id,
+            'duration_ms': duration_ms,
+            'track_number': get('track_number', 1),
+            'external_url': external_urls['spotify'],
+            'preview_url': get('preview_url'),
+            'album_art': album_art,
+            'release_date': release_date
+        }
+
+    def _serialize_full_track(self, track: Dict) -> Dict:
+        """Serialize a full track object, which embeds its album"""
+        album = track['album']
+        album_artist_names = tuple([artist['name'] for artist in album['artists']])
+        # Single literal so the dict is allocated at its final size instead
+        # of growing through post-construction inserts
+        return {
+            **self._serialize_track(
+                track,
+                album_name=album['name'],
+                album_id=album['id'],
+                album_art=self._serialize_album_images(album['images']),
+                release_date=album.get('release_date', '')
+            ),
+            'album_artists': album_artist_names,
+            'album_artist': ', '.join(album_artist_names)
+        }
+
     def __init__(self):
         if not config.SPOTIFY_CLIENT_ID or not config.SPOTIFY_CLIENT_SECRET:
             raise ValueError("Spotify credentials not configured. Set SPOTIFY_CLIENT_ID and SPOTIFY_CLIENT_SECRET")
@@ -15,164 +110,384 @@ class SpotifyService:
             client_id=config.SPOTIFY_CLIENT_ID,
             client_secret=config.SPOTIFY_CLIENT_SECRET
         )
-        self.client = spotipy.Spotify(client_credentials_manager=client_credentials_manager)
-    
-    def search_tracks(self, query: str, limit: int = 20) -> List[Dict]:
-        """Search for tracks on Spotify"""
+        # retries=0 so spotipy doesn't retry underneath _call's own
+        # Retry-After/backoff handling
+        self.client = spotipy.Spotify(
+            client_credentials_manager=client_credentials_manager,
+            requests_session=_OrjsonSession(),
+            retries=0
+        )
+
+        # Metadata for a given Spotify ID is effectively immutable, so repeat
+        # lookups within the TTL skip the HTTP round-trip entirely. Album
+        # entries include the fully paginated track list.
+        self._track_cache = TTLCache(maxsize=10_000, ttl=3600)
+        self._album_cache = TTLCache(maxsize=2_000, ttl=3600)
+        self._cache_lock = RLock()
+
+        # SQLite-backed cache so resolved metadata survives process restarts;
+        # records are stored as orjson blobs keyed by "track:<id>" etc.
+        self._disk_cache = diskcache.Cache(config.SPOTIFY_CACHE_DIR)
+
+        # In-flight lookups keyed by ID, so concurrent requests for the same
+        # track/album share one fetch instead of racing past the cold cache
+        self._inflight_tracks: Dict[str, Future] = {}
+        self._inflight_albums: Dict[str, asyncio.Future] = {}
+        self._inflight_lock = Lock()
+
+    def _call(self, fn, *args, **kwargs):
+        """Call a spotipy client method, retrying on 429s and transient 5xx
+
+        A 429 sleeps for the Retry-After the API hands back; 5xx responses
+        back off exponentially. Other client errors won't succeed on retry
+        and are raised immediately.
+        """
+        backoff = 1
+        for attempt in range(self.MAX_RETRIES + 1):
+            try:
+                return fn(*args, **kwargs)
+            except SpotifyException as e:
+                if attempt == self.MAX_RETRIES:
+                    raise
+                if e.http_status == 429:
+                    retry_after = int((e.headers or {}).get('Retry-After', 1))
+                    logger.warning("Spotify rate limited, retrying in %ss", retry_after)
+                    time.sleep(retry_after)
+                elif e.http_status and e.http_status >= 500:
+                    time.sleep(backoff)
+                    backoff *= 2
+                else:
+                    raise
+
+    def _disk_get(self, key: str):
+        """Look up a serialized record in the persistent cache"""
         try:
-            results = self.client.search(q=query, type='track', limit=limit)
-            tracks = []
-            
-            for item in results['tracks']['items']:
-                track = {
-                    'id': item['id'],
-                    'name': item['name'],
-                    'artists': [artist['name'] for artist in item['artists']],
-                    'artist': ', '.join([artist['name'] for artist in item['artists']]),
-                    'album': item['album']['name'],
-                    'album_id': item['album']['id'],
-                    'duration_ms': item['duration_ms'],
-                    'external_url': item['external_urls']['spotify'],
-                    'preview_url': item.get('preview_url'),
-                    # Get the largest image (first in array, sorted by size descending)
-                    'album_art': item['album']['images'][0]['url'] if item['album']['images'] else None,
-                    'release_date': item['album'].get('release_date', '')
-                }
-                tracks.append(track)
-            
-            return tracks
+            raw = self._disk_cache.get(key)
         except Exception as e:
-            print(f"Spotify search error: {e}")
+            logger.warning("Spotify disk cache read error: %s", e)
+            return None
+        return orjson.loads(raw) if raw is not None else None
+
+    def _disk_set(self, key: str, value, ttl: Optional[int] = None) -> None:
+        """Store a record in the persistent cache"""
+        try:
+            self._disk_cache.set(key, orjson.dumps(value),
+                                 expire=ttl or config.SPOTIFY_CACHE_TTL)
+        except Exception as e:
+            logger.warning("Spotify disk cache write error: %s", e)
+    
+    def _serialize_search_track(self, item: Dict) -> Dict:
+        """Serialize a search result track, which embeds its album"""
+        album = item['album']
+        return self._serialize_track(
+            item,
+            album_name=album['name'],
+            album_id=album['id'],
+            album_art=self._serialize_album_images(album['images']),
+            release_date=album.get('release_date', '')
+        )
+
+    def _serialize_album(self, item: Dict) -> Dict:
+        """Build the album dict returned by album searches"""
+        names = tuple([artist['name'] for artist in item['artists']])
+        return {
+            'id': item['id'],
+            'name': item['name'],
+            'artist': ', '.join(names),
+            'artists': names,
+            'release_date': item.get('release_date', ''),
+            'total_tracks': item.get('total_tracks', 0),
+            'album_art': self._serialize_album_images(item['images']),
+            'external_url': item['external_urls']['spotify']
+        }
+
+    def _paginated_search(self, qtype: str, query: str, limit: int, serializer) -> List[Dict]:
+        """Run a search and serialize its result envelope
+
+        Single code path shared by every search_* method, so disk caching,
+        retry/backoff and record building only exist in one place.
+        """
+        cache_key = f"search:{qtype}:{query}:{limit}"
+        cached = self._disk_get(cache_key)
+        if cached is not None:
+            return cached
+
+        try:
+            results = self._call(self.client.search, q=query, type=qtype, limit=limit)
+            records = [serializer(item) for item in results[f'{qtype}s']['items']]
+            self._disk_set(cache_key, records, ttl=self.SEARCH_CACHE_TTL)
+            return records
+        except Exception:
+            logger.exception("Spotify %s search failed", qtype)
             raise
+
+    def search_tracks(self, query: str, limit: int = 20) -> List[Dict]:
+        """Search for tracks on Spotify"""
+        return self._paginated_search('track', query, limit, self._serialize_search_track)
     
     def get_track_details(self, track_id: str) -> Optional[Dict]:
         """Get detailed information about a specific track"""
+        with self._cache_lock:
+            cached = self._track_cache.get(track_id)
+        if cached is not None:
+            # Callers (e.g. metadata tagging) mutate the dict in place, so
+            # hand out a copy instead of the cached record itself
+            return dict(cached)
+
+        # Coalesce concurrent lookups of the same ID: the first caller does
+        # the fetch, later callers wait on its result
+        with self._inflight_lock:
+            pending = self._inflight_tracks.get(track_id)
+            if pending is None:
+                future = Future()
+                self._inflight_tracks[track_id] = future
+        if pending is not None:
+            details = pending.result()
+            return dict(details) if details is not None else None
+
         try:
-            track = self.client.track(track_id)
-            return {
-                'id': track['id'],
-                'name': track['name'],
-                'artists': [artist['name'] for artist in track['artists']],
-                'artist': ', '.join([artist['name'] for artist in track['artists']]),
-                'album_artists': [album_artist['name'] for album_artist in track['album']['artists']],
-                'album_artist': ', '.join([album_artist['name'] for album_artist in track['album']['artists']]),
-                'album': track['album']['name'],
-                'album_id': track['album']['id'],
-                'duration_ms': track['duration_ms'],
-                'external_url': track['external_urls']['spotify'],
-                'preview_url': track.get('preview_url'),
-                'track_number': track.get('track_number', 1),
-                # Get the largest image (first in array, sorted by size descending)
-                'album_art': track['album']['images'][0]['url'] if track['album']['images'] else None,
-                'release_date': track['album'].get('release_date', '')
-            }
-        except Exception as e:
-            print(f"Error fetching track details: {e}")
-            return None
+            details = self._fetch_track_details(track_id)
+            future.set_result(details)
+        except BaseException as e:
+            future.set_exception(e)
+            raise
+        finally:
+            with self._inflight_lock:
+                self._inflight_tracks.pop(track_id, None)
+        return dict(details) if details is not None else None
+
+    def _fetch_track_details(self, track_id: str) -> Optional[Dict]:
+        """Resolve track details from the disk cache or Spotify"""
+        details = self._disk_get(f"track:{track_id}")
+        if details is None:
+            try:
+                track = self._call(self.client.track, track_id)
+            except Exception:
+                logger.exception("Error fetching track details for %s", track_id)
+                return None
+            details = self._serialize_full_track(track)
+            self._disk_set(f"track:{track_id}", details)
+        with self._cache_lock:
+            self._track_cache[track_id] = details
+        return details
+
+    def get_tracks_details(self, track_ids: List[str]) -> List[Dict]:
+        """Get details for multiple tracks in batches of 50 per request
+
+        Uses Spotify's batch /v1/tracks endpoint, so N tracks cost ceil(N/50)
+        round-trips instead of N. Already-cached tracks are not re-fetched;
+        unknown IDs are silently dropped from the result.
+        """
+        details_by_id = {}
+        with self._cache_lock:
+            for track_id in track_ids:
+                cached = self._track_cache.get(track_id)
+                if cached is not None:
+                    details_by_id[track_id] = cached
+
+        missing = []
+        for track_id in track_ids:
+            if track_id in details_by_id:
+                continue
+            details = self._disk_get(f"track:{track_id}")
+            if details is not None:
+                details_by_id[track_id] = details
+                with self._cache_lock:
+                    self._track_cache[track_id] = details
+            else:
+                missing.append(track_id)
+
+        try:
+            for i in range(0, len(missing), self.TRACKS_BATCH_SIZE):
+                chunk = missing[i:i + self.TRACKS_BATCH_SIZE]
+                response = self._call(self.client.tracks, chunk)
+                for track in response['tracks']:
+                    # Unknown/removed IDs come back as null entries
+                    if not track:
+                        continue
+                    details = self._serialize_full_track(track)
+                    details_by_id[track['id']] = details
+                    self._disk_set(f"track:{track['id']}", details)
+                    with self._cache_lock:
+                        self._track_cache[track['id']] = details
+        except Exception:
+            logger.exception("Error fetching track details batch")
+            raise
+
+        return [dict(details_by_id[track_id]) for track_id in track_ids
+                if track_id in details_by_id]
     
     def search_albums(self, query: str, limit: int = 20) -> List[Dict]:
         """Search for albums on Spotify"""
-        try:
-            results = self.client.search(q=query, type='album', limit=limit)
-            albums = []
-            
-            for item in results['albums']['items']:
-                album = {
-                    'id': item['id'],
-                    'name': item['name'],
-                    'artist': ', '.join([artist['name'] for artist in item['artists']]),
-                    'artists': [artist['name'] for artist in item['artists']],
-                    'release_date': item.get('release_date', ''),
-                    'total_tracks': item.get('total_tracks', 0),
-                    'album_art': item['images'][0]['url'] if item['images'] else None,
-                    'external_url': item['external_urls']['spotify']
-                }
-                albums.append(album)
-            
-            return albums
-        except Exception as e:
-            print(f"Spotify album search error: {e}")
-            raise
+        return self._paginated_search('album', query, limit, self._serialize_album)
     
-    def get_album_details(self, album_id: str) -> Optional[Dict]:
+    @staticmethod
+    def _copy_album(album: Dict) -> Dict:
+        """Copy a cached album record, including its per-track dicts"""
+        copied = dict(album)
+        copied['tracks'] = [dict(track) for track in album['tracks']]
+        return copied
+
+    async def get_album_details(self, album_id: str) -> Optional[Dict]:
         """Get detailed information about an album including all tracks"""
+        with self._cache_lock:
+            cached = self._album_cache.get(album_id)
+        if cached is not None:
+            return self._copy_album(cached)
+
+        # Same coalescing as get_track_details, but with asyncio futures
+        # since album lookups run on the event loop
+        with self._inflight_lock:
+            pending = self._inflight_albums.get(album_id)
+            if pending is None:
+                future = asyncio.get_running_loop().create_future()
+                self._inflight_albums[album_id] = future
+        if pending is not None:
+            details = await pending
+            return self._copy_album(details) if details is not None else None
+
         try:
-            album = self.client.album(album_id)
-            
-            # Get all tracks from the album (handle pagination for albums with >50 tracks)
-            tracks = []
-            
-            # Process first page of tracks
-            for item in album['tracks']['items']:
-                track = {
-                    'id': item['id'],
-                    'name': item['name'],
-                    'artists': [artist['name'] for artist in item['artists']],
-                    'artist': ', '.join([artist['name'] for artist in item['artists']]),
-                    'album': album['name'],
-                    'album_id': album['id'],
-                    'duration_ms': item['duration_ms'],
-                    'track_number': item['track_number'],
-                    'external_url': item['external_urls']['spotify'],
-                    'preview_url': item.get('preview_url'),
-                    'album_art': album['images'][0]['url'] if album['images'] else None,
-                    'release_date': album.get('release_date', '')
+            details = await self._fetch_album_details(album_id)
+            future.set_result(details)
+        except BaseException as e:
+            future.set_exception(e)
+            raise
+        finally:
+            with self._inflight_lock:
+                self._inflight_albums.pop(album_id, None)
+        return self._copy_album(details) if details is not None else None
+
+    async def iter_album_tracks(self, album_id: str, album: Optional[Dict] = None):
+        """Yield serialized album tracks as each page arrives
+
+        The first 50 tracks ship inside the album payload and are yielded
+        after a single round-trip; every remaining page is requested
+        concurrently up front (bounded by MAX_CONCURRENT_PAGES) and yielded
+        in order as it lands, so consumers can start working on the first
+        tracks without waiting for the whole album.
+        """
+        if album is None:
+            with self._cache_lock:
+                cached = self._album_cache.get(album_id)
+            if cached is None:
+                cached = self._disk_get(f"album:{album_id}")
+            if cached is not None:
+                for track in cached['tracks']:
+                    yield dict(track)
+                return
+
+            album = await asyncio.to_thread(self._call, self.client.album, album_id)
+
+        # Album-level fields are identical for every track; compute them
+        # once instead of per item
+        album_id = album['id']
+        album_name = album['name']
+        album_art = self._serialize_album_images(album['images'])
+        release_date = album.get('release_date', '')
+
+        first_page = album['tracks']['items']
+
+        # Spotify returns max 50 tracks per page. The album payload already
+        # tells us the total, so start every remaining page request before
+        # serializing the first page; they resolve while we yield.
+        page_tasks = []
+        if album['tracks'].get('next'):
+            total_tracks = album.get('total_tracks', len(first_page))
+
+            # Safety cap to prevent runaway fetches (max 1000 tracks should be enough)
+            if total_tracks > 1000:
+                logger.warning("Capping pagination at 1000 tracks for album %s", album_id)
+                total_tracks = 1000
+
+            semaphore = asyncio.Semaphore(self.MAX_CONCURRENT_PAGES)
+
+            async def fetch_page(offset: int) -> Dict:
+                async with semaphore:
+                    return await asyncio.to_thread(
+                        self._call, self.client.album_tracks, album_id, limit=50, offset=offset
+                    )
+
+            page_tasks = [
+                asyncio.create_task(fetch_page(offset))
+                for offset in range(len(first_page), total_tracks, 50)
+            ]
+
+        try:
+            for item in first_page:
+                yield self._serialize_track(
+                    item,
+                    album_name=album_name,
+                    album_id=album_id,
+                    album_art=album_art,
+                    release_date=release_date
+                )
+
+            for task in page_tasks:
+                page = await task
+                for item in page['items']:
+                    yield self._serialize_track(
+                        item,
+                        album_name=album_name,
+                        album_id=album_id,
+                        album_art=album_art,
+                        release_date=release_date
+                    )
+        finally:
+            # Don't leak page fetches if the consumer stops early
+            for task in page_tasks:
+                task.cancel()
+
+    def _prime_track_cache(self, album_details: Dict) -> None:
+        """Warm the track cache from a resolved album
+
+        The album payload already carries everything the per-track download
+        path would ask Spotify for, so the N get_track_details calls that
+        follow an album download become cache hits instead of N round-trips.
+        """
+        album_artists = tuple(album_details['artists'])
+        album_artist = ', '.join(album_artists)
+        with self._cache_lock:
+            for track in album_details['tracks']:
+                self._track_cache[track['id']] = {
+                    **track,
+                    'album_artists': album_artists,
+                    'album_artist': album_artist
                 }
-                tracks.append(track)
-            
-            # Handle pagination - Spotify API returns max 50 tracks per page
-            # Continue fetching tracks until we have all of them
-            offset = len(tracks)  # Start from where we left off
-            
-            # Fetch additional pages if there are more tracks (check if 'next' exists in first page)
-            if album['tracks'].get('next'):
-                while True:
-                    # Fetch next page of tracks using album_tracks method with offset
-                    next_page = self.client.album_tracks(album_id, limit=50, offset=offset)
-                    
-                    if not next_page['items']:
-                        break
-                    
-                    for item in next_page['items']:
-                        track = {
-                            'id': item['id'],
-                            'name': item['name'],
-                            'artists': [artist['name'] for artist in item['artists']],
-                            'artist': ', '.join([artist['name'] for artist in item['artists']]),
-                            'album': album['name'],
-                            'album_id': album['id'],
-                            'duration_ms': item['duration_ms'],
-                            'track_number': item['track_number'],
-                            'external_url': item['external_urls']['spotify'],
-                            'preview_url': item.get('preview_url'),
-                            'album_art': album['images'][0]['url'] if album['images'] else None,
-                            'release_date': album.get('release_date', '')
-                        }
-                        tracks.append(track)
-                    
-                    # Check if there are more tracks to fetch
-                    if not next_page.get('next'):
-                        break
-                    
-                    offset += 50
-                    
-                    # Safety check to prevent infinite loops (max 1000 tracks should be enough)
-                    if offset >= 1000:
-                        print(f"Warning: Stopped pagination at 1000 tracks for album {album_id}")
-                        break
-            
-            return {
-                'id': album['id'],
+
+    async def _fetch_album_details(self, album_id: str) -> Optional[Dict]:
+        """Resolve an album and its full track list from the disk cache or Spotify"""
+        details = self._disk_get(f"album:{album_id}")
+        if details is not None:
+            with self._cache_lock:
+                self._album_cache[album_id] = details
+            self._prime_track_cache(details)
+            return details
+
+        try:
+            album = await asyncio.to_thread(self._call, self.client.album, album_id)
+
+            album_id = album['id']
+            album_artist_names = tuple([artist['name'] for artist in album['artists']])
+
+            tracks = [track async for track in self.iter_album_tracks(album_id, album)]
+
+            details = {
+                'id': album_id,
                 'name': album['name'],
-                'artist': ', '.join([artist['name'] for artist in album['artists']]),
-                'artists': [artist['name'] for artist in album['artists']],
+                'artist': ', '.join(album_artist_names),
+                'artists': album_artist_names,
                 'release_date': album.get('release_date', ''),
                 'total_tracks': album.get('total_tracks', 0),
-                'album_art': album['images'][0]['url'] if album['images'] else None,
+                'album_art': self._serialize_album_images(album['images']),
                 'external_url': album['external_urls']['spotify'],
                 'tracks': tracks
             }
-        except Exception as e:
-            print(f"Error fetching album details: {e}")
+            self._disk_set(f"album:{album_id}", details)
+            with self._cache_lock:
+                self._album_cache[album_id] = details
+            self._prime_track_cache(details)
+            return details
+        except Exception:
+            logger.exception("Error fetching album details for %s", album_id)
             return None
 